@@ -95,6 +95,8 @@ class DataModuleConfig:
         self.batch_size: int = kwargs.pop("batch_size", 64)
         self.num_workers: int = kwargs.pop("num_workers", 4)
         self.pin_memory: bool = kwargs.pop("pin_memory", True)
+        self.persistent_workers: bool = kwargs.pop("persistent_workers", True)
+        self.prefetch_factor: int = kwargs.pop("prefetch_factor", 4)
         
         plm_config = AutoConfig.from_pretrained(self.plm_name)
         
@@ -133,6 +135,7 @@ class PreInferSeqDataModuleConfig(SeqDataModuleConfig):
         self.pre_inference_precision = kwargs.pop("pre_inference_precision", 32)
         self.pre_inference_num_workers = kwargs.pop("pre_inference_num_workers", 4)
         self.pre_inference_layer_wise = kwargs.pop("pre_inference_layer_wise", False)
+        self.plm_bf16 = kwargs.pop("plm_bf16", False)
         self.pre_inference_devices= kwargs.pop(
             "pre_inference_devices", [0, 1, 2, 3, 4, 5, 6, 7]
             )
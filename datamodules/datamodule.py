@@ -1,3 +1,4 @@
+from torch.utils.data import DataLoader
 from pytorch_lightning import LightningDataModule
 from datamodules.configs import DataModuleConfig, get_data_configs
 from models.utils import PRETRAIN_MODEL_ABBR
@@ -26,6 +27,21 @@ class DataModule(LightningDataModule):
         self.data_val = None
         self.data_test = None
 
+    def _build_dataloader(self, dataset, shuffle, **kwargs):
+        """Build a dataloader of the dataset with the shared loading configs."""
+        dm_config = self.hparams.dm_config
+        if dm_config.num_workers > 0:
+            # keep the workers and a few batches ready between epochs
+            kwargs.update(persistent_workers=dm_config.persistent_workers,
+                          prefetch_factor=dm_config.prefetch_factor)
+        return DataLoader(
+            dataset=dataset,
+            batch_size=dm_config.batch_size,
+            num_workers=dm_config.num_workers,
+            pin_memory=dm_config.pin_memory,
+            shuffle=shuffle,
+            **kwargs)
+
     @classmethod
     def add_datamodule_specific_args(cls, parent_parser):
         """Add datamodule specific arguments to the parser."""
@@ -36,7 +52,11 @@ class DataModule(LightningDataModule):
         parser.add_argument("--tokenized_len", type=int, default=30)
         parser.add_argument("--batch_size", type=int, default=64)
         parser.add_argument("--num_workers", type=int, default=4)
-        parser.add_argument("--pin_memory", type=parse_boolean, default=False)
+        parser.add_argument("--pin_memory", type=parse_boolean, default=True)
+        parser.add_argument("--persistent_workers",
+                            type=parse_boolean,
+                            default=True)
+        parser.add_argument("--prefetch_factor", type=int, default=4)
         parser.add_argument("--min_item_seq_len", type=int, default=5)
         parser.add_argument("--max_item_seq_len",
                             type=int_or_none,
@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from utils.pylogger import get_pylogger
 
 log = get_pylogger(__name__)
@@ -18,6 +19,8 @@ class IDSeqRecDataset(Dataset):
         self.input_id_seqs = input_id_seqs
         self.target_id_seqs = target_id_seqs
         self.item_seq_masks = self._get_masks(self.input_id_seqs)
+        # index of the last valid item of each sequence
+        self.last_item_idxs = self.item_seq_masks.sum(axis=-1) - 1
 
     def _get_masks(self, data):
         masks = np.where(data != self.padding_idx, True, False)
@@ -30,7 +33,8 @@ class IDSeqRecDataset(Dataset):
         item_id_seq = self.input_id_seqs[idx]
         target_id_seq = self.target_id_seqs[idx]
         item_seq_mask = self.item_seq_masks[idx]
-        return target_id_seq, item_id_seq, item_seq_mask
+        last_item_idx = self.last_item_idxs[idx]
+        return target_id_seq, item_id_seq, item_seq_mask, last_item_idx
 
 
 class TextSeqRecDataset(IDSeqRecDataset):
@@ -46,16 +50,30 @@ class TextSeqRecDataset(IDSeqRecDataset):
         super().__init__(input_id_seqs, target_id_seqs, padding_idx)
         self.tokenized_ids = tokenized_ids
         self.attention_mask = attention_mask
+        # turned off by a model that looks the items up in its own cache of
+        # plm embeddings, the batches then carry no tokens
+        self.with_tokens = True
 
     def __len__(self):
         return self._len
 
-    def __getitem__(self, idx):
-        target_id_seq, item_id_seq, item_seq_mask = super().__getitem__(idx)
-        tokenized_ids = self.tokenized_ids[item_id_seq]
-        attention_mask = self.attention_mask[item_id_seq]
-        return target_id_seq, item_id_seq, item_seq_mask, \
-            tokenized_ids, attention_mask
+    def collect_fn(self, batch):
+        target_id_seq, item_id_seq, item_seq_mask, last_item_idx = \
+            default_collate(batch)
+        if not self.with_tokens:
+            return target_id_seq, item_id_seq, item_seq_mask, last_item_idx, \
+                None, None, None
+        # items recur across the sequences of a batch, only gather the tokens
+        # of each distinct item once, so the plm runs once per item
+        unique_ids, item_inverse = torch.unique(item_id_seq,
+                                                return_inverse=True)
+        unique_ids = unique_ids.numpy()
+        # (N_unique, L_plm)
+        tokenized_ids = torch.from_numpy(self.tokenized_ids[unique_ids])
+        attention_mask = torch.from_numpy(self.attention_mask[unique_ids])
+        # item_inverse (B, L_sas) indexes the rows of tokenized_ids
+        return target_id_seq, item_id_seq, item_seq_mask, last_item_idx, \
+            tokenized_ids, attention_mask, item_inverse
 
 
 class PreInferTextSeqRecDataset(IDSeqRecDataset):
@@ -75,11 +93,17 @@ class PreInferTextSeqRecDataset(IDSeqRecDataset):
     def __len__(self):
         return self._len
 
-    def __getitem__(self, idx):
-        target_id_seq, item_id_seq, item_seq_mask = super().__getitem__(idx)
-        tokenized_embs = self.tokenized_embs[item_id_seq]
-        attention_mask = self.attention_mask[item_id_seq]
-        return target_id_seq, item_id_seq, item_seq_mask, \
+    def collect_fn(self, batch):
+        target_id_seq, item_id_seq, item_seq_mask, last_item_idx = \
+            default_collate(batch)
+        # gather the embs of the whole batch at once, already flattened to
+        # the (B * L_sas, ...) layout of the plm inputs
+        flat_item_ids = item_id_seq.view(-1)
+        # (B * L_sas, L_plm, H_plm)
+        tokenized_embs = self.tokenized_embs[flat_item_ids]
+        # (B * L_sas, L_plm)
+        attention_mask = self.attention_mask[flat_item_ids]
+        return target_id_seq, item_id_seq, item_seq_mask, last_item_idx, \
             tokenized_embs, attention_mask
 
 
@@ -99,9 +123,11 @@ class AllFreezePreInferTextSeqRecDataset(IDSeqRecDataset):
         return self._len
 
     def __getitem__(self, idx):
-        target_id_seq, item_id_seq, item_seq_mask = super().__getitem__(idx)
+        target_id_seq, item_id_seq, item_seq_mask, last_item_idx = \
+            super().__getitem__(idx)
         item_emb_seq = self.item_embs[item_id_seq]
-        return target_id_seq, item_id_seq, item_seq_mask, item_emb_seq
+        return target_id_seq, item_id_seq, item_seq_mask, last_item_idx, \
+            item_emb_seq
 
 
 class IDPointWiseRecDataset(Dataset):
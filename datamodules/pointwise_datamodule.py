@@ -1,7 +1,6 @@
 import os
 import pandas as pd
 import numpy as np
-from torch.utils.data import DataLoader
 from datamodules.datamodule import DataModule
 from datamodules.utils import (ratio_split, str_fields2ndarray,
                                point_wise_leave_one_out_split, 
@@ -255,34 +254,19 @@ class PointWiseDataModule(DataModule):
 
     def train_dataloader(self):
         """Return the training dataloader."""
-        return DataLoader(
-            dataset=self.data_train,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
+        return self._build_dataloader(
+            self.data_train,
             shuffle=True,
             collate_fn=self.data_train.collect_fn,
         )
 
     def val_dataloader(self):
         """Return the validation dataloader."""
-        return DataLoader(
-            dataset=self.data_val,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
-            shuffle=False,
-        )
+        return self._build_dataloader(self.data_val, shuffle=False)
 
     def test_dataloader(self):
         """Return the test dataloader."""
-        return DataLoader(
-            dataset=self.data_test,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
-            shuffle=False,
-        )
+        return self._build_dataloader(self.data_test, shuffle=False)
 
     @classmethod
     def add_datamodule_specific_args(cls, parent_parser):
@@ -306,6 +290,8 @@ class PointWiseDataModule(DataModule):
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=args.pin_memory,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
         )
         try:
             config.plm_name = args.plm_name
@@ -2,7 +2,6 @@ import os
 import torch
 import pandas as pd
 import numpy as np
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from utils.cli_parse import parse_boolean
 from utils.pylogger import get_pylogger
@@ -212,6 +211,9 @@ class SeqDataModule(DataModule):
                 fields=[TEXT_ID_SEQ_FIELD, ATTENTION_MASK_FIELD],
                 field_lens=[tokenized_len, tokenized_len],
             )
+            # the plm vocab fits in int32, halving the token bytes per batch
+            tokenized_ids = tokenized_ids.astype(np.int32)
+            attention_mask = attention_mask.astype(bool)
 
             [data_train, data_val, data_test] = [
                 TextSeqRecDataset(
@@ -264,30 +266,24 @@ class SeqDataModule(DataModule):
 
     def train_dataloader(self):
         """Return the training dataloader."""
-        return DataLoader(
-            dataset=self.data_train,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
-            shuffle=True)
+        return self._build_dataloader(
+            self.data_train,
+            shuffle=True,
+            collate_fn=getattr(self.data_train, "collect_fn", None))
 
     def val_dataloader(self):
         """Return the validation dataloader."""
-        return DataLoader(
-            dataset=self.data_val,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
-            shuffle=False)
+        return self._build_dataloader(
+            self.data_val,
+            shuffle=False,
+            collate_fn=getattr(self.data_val, "collect_fn", None))
 
     def test_dataloader(self):
         """Return the test dataloader."""
-        return DataLoader(
-            dataset=self.data_test,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
-            shuffle=False)
+        return self._build_dataloader(
+            self.data_test,
+            shuffle=False,
+            collate_fn=getattr(self.data_test, "collect_fn", None))
 
     @classmethod
     def add_datamodule_specific_args(cls, parent_parser):
@@ -311,6 +307,8 @@ class SeqDataModule(DataModule):
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=args.pin_memory,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
         )
         try:
             config.plm_name = args.plm_name
@@ -336,6 +334,8 @@ class PreInferSeqDataModule(SeqDataModule):
             processed_dir=self.processed_dir,
             plm_name=plm_name,
             last_n_unfreeze=last_n_unfreeze)
+        # known on every rank, prepare_data (and the pre-inference writing
+        # this file) only runs on a single process
         tokenized_embs_file = self.file_getter.get_inference_file()
         self.tokenized_embs_path = os.path.join(
             self.processed_dir, tokenized_embs_file)
@@ -400,7 +400,8 @@ class PreInferSeqDataModule(SeqDataModule):
                 fields=[TEXT_ID_SEQ_FIELD, ATTENTION_MASK_FIELD],
                 field_lens=[tokenized_len, tokenized_len])
             
-            tokenized_embs = torch.load(self.tokenized_embs_path)
+            tokenized_embs = torch.load(
+                self.tokenized_embs_path, map_location="cpu")
             attention_mask = torch.tensor(attention_mask, dtype=torch.bool)
             
             # sampling the item embeddings
@@ -411,6 +412,10 @@ class PreInferSeqDataModule(SeqDataModule):
                     sampled_iids[0].values, dtype=torch.long)
                 tokenized_embs = tokenized_embs[sampled_iids]
             
+            # halve the memory and the host to device traffic of the embs
+            if self.hparams.dm_config.plm_bf16:
+                tokenized_embs = tokenized_embs.to(torch.bfloat16)
+            
             [data_train, data_val, data_test] = [
                 PreInferTextSeqRecDataset(
                     input_id_seqs=input_item_id_seqs[stage],
@@ -426,33 +431,6 @@ class PreInferSeqDataModule(SeqDataModule):
 
             self.num_items = len(items)
 
-    def train_dataloader(self):
-        """Return the training dataloader."""
-        return DataLoader(
-            dataset=self.data_train,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
-            shuffle=True)
-
-    def val_dataloader(self):
-        """Return the validation dataloader."""
-        return DataLoader(
-            dataset=self.data_val,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
-            shuffle=False)
-
-    def test_dataloader(self):
-        """Return the test dataloader."""
-        return DataLoader(
-            dataset=self.data_test,
-            batch_size=self.hparams.dm_config.batch_size,
-            num_workers=self.hparams.dm_config.num_workers,
-            pin_memory=self.hparams.dm_config.pin_memory,
-            shuffle=False)
-
     @classmethod
     def add_datamodule_specific_args(cls, parent_parser):
         """Add datamodule specific arguments to the parser."""
@@ -484,6 +462,7 @@ class PreInferSeqDataModule(SeqDataModule):
             pre_inference_devices=args.pre_inference_devices,
             pre_inference_num_workers=args.pre_inference_num_workers,
             pre_inference_layer_wise=args.pre_inference_layer_wise,
+            plm_bf16=args.plm_bf16,
             min_item_seq_len=args.min_item_seq_len,
             max_item_seq_len=args.max_item_seq_len,
             sasrec_seq_len=args.sasrec_seq_len,
@@ -491,6 +470,8 @@ class PreInferSeqDataModule(SeqDataModule):
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=args.pin_memory,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
             )
         return config
 
@@ -500,8 +481,19 @@ class AllFreezePreInferSeqDataModule(PreInferSeqDataModule):
         self.save_hyperparameters(logger=True)
         super().__init__(dm_config)
         
+        # the pooled item embs are cached beside the (resampled) items
+        pooling_method = self.hparams.dm_config.pooling_method
+        item_embs_dir = self.resample_dir \
+            if self.hparams.dm_config.sampling_n is not None \
+            else self.processed_dir
+        item_embs_file = os.path.basename(self.tokenized_embs_path).replace(
+            ".pt", f"_{pooling_method}_pooled.pt")
+        self.item_embs_path = os.path.join(item_embs_dir, item_embs_file)
+        
     def prepare_data(self):
         num_items = super().prepare_data()
+        # only called on a single process, so the cache is written once
+        self._prepare_item_embs()
         return num_items
     
     def setup(self, stage=None):
@@ -528,25 +520,10 @@ class AllFreezePreInferSeqDataModule(PreInferSeqDataModule):
                 self._split_processed_inters_df(
                     inters=inters, split_type=split_type, stages=stages)
 
-            tokenized_len = self.hparams.dm_config.tokenized_len
-            tokenized_ids, attention_mask = str_fields2ndarray(
-                df=items,
-                fields=[TEXT_ID_SEQ_FIELD, ATTENTION_MASK_FIELD],
-                field_lens=[tokenized_len, tokenized_len])
-            
-            
-            tokenized_embs = torch.load(self.tokenized_embs_path)
-            attention_mask = torch.tensor(attention_mask, dtype=torch.bool)
-            
-            # sampling the item embeddings
-            if sampling_n is not None:
-                sampled_iids = pd.read_csv(
-                    self.sampled_iids_path, sep="\t", header=None)
-                sampled_iids = torch.tensor(
-                    sampled_iids[0].values, dtype=torch.long)
-                tokenized_embs = tokenized_embs[sampled_iids]
-            
-            item_embs = self._pooling(tokenized_embs, attention_mask)
+            # pooled and cached by prepare_data
+            item_embs = torch.load(self.item_embs_path, map_location="cpu")
+            if self.hparams.dm_config.plm_bf16:
+                item_embs = item_embs.to(torch.bfloat16)
             
             [data_train, data_val, data_test] = [
                 AllFreezePreInferTextSeqRecDataset(
@@ -562,6 +539,48 @@ class AllFreezePreInferSeqDataModule(PreInferSeqDataModule):
 
             self.num_items = len(items)    
     
+    def _prepare_item_embs(self):
+        """Pool the item embs and cache them, unless already cached.
+        
+        The pooled embs are much smaller than the (N, L_plm, H_plm) token
+        embs, so the later runs skip loading and pooling the token embs.
+        """
+        # a re-run pre-inference invalidates the cached pooled embs
+        if os.path.exists(self.item_embs_path) and \
+            os.path.getmtime(self.item_embs_path) >= \
+                os.path.getmtime(self.tokenized_embs_path):
+            log.info(f"Pooled item embeddings already cached in "
+                     f"{self.item_embs_path}")
+            return
+
+        sampling_n = self.hparams.dm_config.sampling_n
+        if sampling_n is not None:
+            items_path = self.sampled_items_path
+        else:
+            items_path = self.items_path
+        items = pd.read_csv(items_path, sep="\t", header=0)
+
+        tokenized_len = self.hparams.dm_config.tokenized_len
+        _, attention_mask = str_fields2ndarray(
+            df=items,
+            fields=[TEXT_ID_SEQ_FIELD, ATTENTION_MASK_FIELD],
+            field_lens=[tokenized_len, tokenized_len])
+        
+        tokenized_embs = torch.load(
+            self.tokenized_embs_path, map_location="cpu")
+        attention_mask = torch.tensor(attention_mask, dtype=torch.bool)
+        
+        # sampling the item embeddings
+        if sampling_n is not None:
+            sampled_iids = pd.read_csv(
+                self.sampled_iids_path, sep="\t", header=None)
+            sampled_iids = torch.tensor(
+                sampled_iids[0].values, dtype=torch.long)
+            tokenized_embs = tokenized_embs[sampled_iids]
+        
+        item_embs = self._pooling(tokenized_embs, attention_mask)
+        torch.save(item_embs, self.item_embs_path)
+    
     def _pooling(self, tokenized_embs, attention_mask):
         pooling_method = self.hparams.dm_config.pooling_method
         
@@ -577,12 +596,14 @@ class AllFreezePreInferSeqDataModule(PreInferSeqDataModule):
         
         num_items = tokenized_embs.shape[0]
         emb_dim = tokenized_embs.shape[-1]
+        chunk_size = 1024
         
         item_embs = torch.empty((num_items, emb_dim), dtype=torch.float32)
         log.info(f"Using {pooling_method} pooling method to pool item embeddings...")
-        for i, embs, mask in tqdm(
-            zip(range(num_items), tokenized_embs, attention_mask), total=num_items):
-            item_embs[i] = pooling_func(embs, mask)
+        for start in tqdm(range(0, num_items, chunk_size)):
+            end = start + chunk_size
+            item_embs[start:end] = pooling_func(
+                tokenized_embs[start:end], attention_mask[start:end])
         return item_embs
     
     @classmethod
@@ -600,6 +621,7 @@ class AllFreezePreInferSeqDataModule(PreInferSeqDataModule):
             pre_inference_devices=args.pre_inference_devices,
             pre_inference_num_workers=args.pre_inference_num_workers,
             pre_inference_layer_wise=args.pre_inference_layer_wise,
+            plm_bf16=args.plm_bf16,
             min_item_seq_len=args.min_item_seq_len,
             max_item_seq_len=args.max_item_seq_len,
             sasrec_seq_len=args.sasrec_seq_len,
@@ -607,5 +629,7 @@ class AllFreezePreInferSeqDataModule(PreInferSeqDataModule):
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=args.pin_memory,
+            persistent_workers=args.persistent_workers,
+            prefetch_factor=args.prefetch_factor,
             )
         return config
\ No newline at end of file
@@ -194,11 +194,10 @@ def pre_inference(
         )
 
     if file_processor.exists_inference_file():
-        embs_file = file_processor.get_inference_file()
         log.info(
             f"Already inferenced {plm_name} for unfreeze last {last_n_unfreeze} layers"
         )
-        return torch.load(os.path.join(processed_dir, embs_file))
+        return
 
     log.info(
         f"Start inferencing {plm_name} for unfreeze last {last_n_unfreeze} layers..."
@@ -1,3 +1,4 @@
+import inspect
 from abc import abstractmethod, ABC
 import torch
 import torch.nn as nn
@@ -5,6 +6,7 @@ import pytorch_lightning as pl
 from torchmetrics import MetricCollection
 from utils.metrics import MRR, NDCG, HR
 from utils.pylogger import get_pylogger
+from utils.cli_parse import parse_boolean
 from models.sasrec import SASRec
 from models.configs import SeqRecConfig, TextSeqRecConfig
 from models.utils import gather_indexes
@@ -49,7 +51,8 @@ class SeqRec(pl.LightningModule, ABC):
         self.topk_metric.update({f"NDCG@{k}": NDCG(k=k) for k in topk_list})
         self.topk_metric = MetricCollection(self.topk_metric)
 
-        self.loss_fct = nn.CrossEntropyLoss()
+        # item id 0 is [PAD], padded targets do not count in the loss
+        self.loss_fct = nn.CrossEntropyLoss(ignore_index=0)
 
     def _init_weights(self, module):
         """Initialize the weights"""
@@ -64,6 +67,14 @@ class SeqRec(pl.LightningModule, ABC):
         if isinstance(module, nn.Embedding) and module.padding_idx is not None:
             module.weight.data[module.padding_idx].zero_()
 
+    def _init_module_weights(self, module_names):
+        """Initialize the weights of the named submodules only, so the
+        pretrained PLM weights are kept and never walked."""
+        for name in module_names:
+            module = getattr(self, name, None)
+            if module is not None:
+                module.apply(self._init_weights)
+
     @abstractmethod
     def _set_feature_extractor(self):
         raise NotImplementedError
@@ -75,6 +86,31 @@ class SeqRec(pl.LightningModule, ABC):
     def forward(self, input):
         raise NotImplementedError
 
+    def _build_adamw(self, params, **kwargs):
+        """Build AdamW with the fused CUDA kernel when this torch supports it
+        and all the parameters are on GPU, else with the multi-tensor
+        implementation."""
+        params = list(params)
+        # params are either tensors or param groups
+        tensors = [
+            p for group in params
+            for p in (group["params"] if isinstance(group, dict) else [group])
+        ]
+        adamw_args = inspect.signature(torch.optim.AdamW).parameters
+        # e.g. the fsdp cpu offload keeps the parameters on cpu
+        if "fused" in adamw_args and all(p.is_cuda for p in tensors):
+            kwargs.update(fused=True)
+        elif "foreach" in adamw_args:
+            kwargs.update(foreach=True)
+        return torch.optim.AdamW(params, **kwargs)
+
+    def _compute_loss(self, seq_emb, target_seq):
+        seq_emb = seq_emb.reshape(-1, seq_emb.size(-1))  # (B * L, N_items)
+        target_seq = target_seq.reshape(-1)  # (B * L)
+        # drop the padded rows before the softmax over all items
+        valid = target_seq != self.loss_fct.ignore_index
+        return self.loss_fct(seq_emb[valid], target_seq[valid])
+
     def training_step(self, batch, batch_idx):
         raise NotImplementedError
     
@@ -173,17 +209,48 @@ class TextSeqRec(SeqRec, ABC):
         projection_sizes = [output_size] + \
             projection_inner_sizes + [hidden_size]
         # mlps with residual connections for projection
-        self.projection = torch.nn.ModuleList()
-        self.projection = nn.ModuleList()
-        for i in range(projection_n_layers):
-            self.projection.append(
-                nn.Sequential(
-                    nn.Linear(projection_sizes[i], projection_sizes[i + 1]),
-                    # nn.GELU()
-                ))
+        # a single Sequential, so the stack runs (and compiles) as one module
+        self.projection = nn.Sequential(*[
+            nn.Sequential(
+                nn.Linear(projection_sizes[i], projection_sizes[i + 1]),
+                # nn.GELU()
+            ) for i in range(projection_n_layers)
+        ])
         # layer_norm_eps = config.layer_norm_eps
         # self.projection.append(nn.LayerNorm(hidden_size, eps=layer_norm_eps))
 
+    def _compile_modules(self):
+        if not hasattr(torch, "compile"):
+            log.warning(f"torch.compile is not supported by torch "
+                        f"{torch.__version__}, running in eager mode.")
+            return False
+        # compile the forward of the projection stack as a whole to fuse its
+        # small ops, the module itself is kept so the checkpoint keys remain,
+        # its batch dim (the distinct items of a batch) changes every step,
+        # so the shapes are left dynamic and autotuning is not rerun per shape
+        self.projection.forward = torch.compile(self.projection.forward,
+                                                fullgraph=True)
+        # compile the forwards rather than wrapping the modules, a wrapped
+        # module would prefix its checkpoint keys with _orig_mod
+        self.sasrec.forward = torch.compile(self.sasrec.forward,
+                                            mode="reduce-overhead")
+        self.classification_head.forward = torch.compile(
+            self.classification_head.forward, mode="max-autotune")
+        return True
+
+    def _get_prompt_mask(self, cache_name, batch_size, seq_len,
+                         attention_mask):
+        mask = getattr(self, cache_name)
+        if mask is None or mask.shape[0] < batch_size \
+                or mask.dtype != attention_mask.dtype \
+                or mask.device != attention_mask.device:
+            mask = torch.ones(batch_size,
+                              seq_len,
+                              dtype=attention_mask.dtype,
+                              device=attention_mask.device)
+            setattr(self, cache_name, mask)
+        return mask[:batch_size]
+
     @abstractmethod
     def _set_plm_model(self, config):
         raise NotImplementedError
@@ -206,10 +273,14 @@ class TextSeqRec(SeqRec, ABC):
                             type=int,
                             nargs="*",
                             default=[3072, 768, 3072, 768])
+        parser.add_argument("--use_torch_compile",
+                            type=parse_boolean,
+                            default=False)
         return parent_parser
 
     @classmethod
     def build_model_config(cls, args, config):
         config = super(TextSeqRec, cls).build_model_config(args, config)
         config.plm_name = args.plm_name
+        config.use_torch_compile = args.use_torch_compile
         return config
\ No newline at end of file
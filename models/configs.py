@@ -25,6 +25,7 @@ class TextSeqRecConfig(SeqRecConfig):
     def __init__(self, item_token_num: int, **kwargs):
         self.plm_name = kwargs.pop("plm_name", 'facebook/opt-125m')
         self.plm_last_n_unfreeze = kwargs.pop("plm_last_n_unfreeze", 0)
+        self.use_torch_compile = kwargs.pop("use_torch_compile", False)
 
         plm_lr = kwargs.pop("plm_lr", 1e-5)
         plm_lr_layer_decay = kwargs.pop("plm_lr_layer_decay", 0.8)
@@ -47,8 +48,30 @@ class OPTSeqRecConfig(TextSeqRecConfig):
     def __init__(self,
                  item_token_num: int,
                  pooling_method: str = 'mean',
+                 plm_bf16: bool = False,
+                 plm_item_cache: bool = True,
+                 plm_jit: bool = False,
+                 plm_length_bucketing: bool = False,
+                 plm_gradient_checkpointing: bool = False,
+                 plm_step_in_backward: bool = False,
+                 plm_offload_embeddings: bool = False,
+                 plm_bucket_size: int = 16,
+                 use_cuda_graph: bool = False,
+                 cuda_graph_capture_sizes: list = [
+                     1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048
+                 ],
                  **kwargs):
         self.pooling_method = pooling_method
+        self.plm_bf16 = plm_bf16
+        self.plm_item_cache = plm_item_cache
+        self.plm_jit = plm_jit
+        self.plm_length_bucketing = plm_length_bucketing
+        self.plm_gradient_checkpointing = plm_gradient_checkpointing
+        self.plm_step_in_backward = plm_step_in_backward
+        self.plm_offload_embeddings = plm_offload_embeddings
+        self.plm_bucket_size = plm_bucket_size
+        self.use_cuda_graph = use_cuda_graph
+        self.cuda_graph_capture_sizes = sorted(cuda_graph_capture_sizes)
 
         if self.pooling_method not in ['mean', 'last']:
             raise ValueError(
@@ -56,6 +79,31 @@ class OPTSeqRecConfig(TextSeqRecConfig):
 
         super().__init__(item_token_num, **kwargs)
 
+        if self.use_cuda_graph and self.plm_last_n_unfreeze != 0:
+            raise ValueError(
+                "use_cuda_graph is only supported when the PLM is frozen, "
+                "please set plm_last_n_unfreeze to 0.")
+        if self.plm_jit and self.plm_last_n_unfreeze != 0:
+            raise ValueError(
+                "plm_jit is only supported when the PLM is frozen, "
+                "please set plm_last_n_unfreeze to 0.")
+        if self.plm_offload_embeddings and self.plm_last_n_unfreeze != 0:
+            raise ValueError(
+                "plm_offload_embeddings is only supported when the PLM is "
+                "frozen, please set plm_last_n_unfreeze to 0.")
+        if self.plm_offload_embeddings and \
+                (self.use_cuda_graph or self.plm_jit):
+            raise ValueError(
+                "plm_offload_embeddings looks up the embeddings on cpu, it "
+                "can not be used with use_cuda_graph or plm_jit.")
+        if self.plm_length_bucketing and self.use_cuda_graph:
+            raise ValueError(
+                "plm_length_bucketing changes the PLM input length every "
+                "step, it can not be used with use_cuda_graph.")
+        assert self.plm_bucket_size > 0
+        assert len(self.cuda_graph_capture_sizes) > 0
+        assert self.cuda_graph_capture_sizes[0] > 0
+
 
 class BERTSeqRecConfig(TextSeqRecConfig):
 
@@ -2,6 +2,7 @@ import copy
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from models.utils import get_plm_configs
 
 
@@ -15,9 +16,17 @@ class PromptEncoder(nn.Module):
                              torch.arange(self.prompt_seq_len).long())
         self.embedding = nn.Embedding(self.prompt_seq_len, hidden_size)
 
+    def encode(self):
+        # the prompt is the same for every sample, (1, prompt_seq_len, H)
+        return self.embedding(self.tokens).unsqueeze(0)
+
+    @staticmethod
+    def expand(prompt_embs, batch_size):
+        # broadcast the encoded prompt over the batch
+        return prompt_embs.expand(batch_size, -1, -1)
+
     def forward(self, batch_size):
-        tokens = self.tokens.unsqueeze(0).expand(batch_size, -1)
-        return self.embedding(tokens)
+        return self.expand(self.encode(), batch_size)
 
 
 class DeepPromptEncoder(nn.Module):
@@ -54,24 +63,35 @@ class DeepPromptEncoder(nn.Module):
             self.embedding = nn.Embedding(prompt_seq_len,
                                           plm_n_layers * 2 * plm_hidden_size)
 
-    def forward(self, batch_size):
-        tokens = self.tokens.unsqueeze(0).expand(batch_size, -1)
-
+    def encode(self):
+        # the prompt is the same for every sample, encode it once
         if self.prompt_projection:
-            prefix_tokens = self.embedding(tokens)
+            prefix_tokens = self.embedding(self.tokens)
             past_key_values = self.trans(prefix_tokens)
         else:
-            past_key_values = self.embedding(tokens)
+            past_key_values = self.embedding(self.tokens)
 
-        past_key_values = past_key_values.view(batch_size, self.prompt_seq_len,
+        past_key_values = past_key_values.view(1, self.prompt_seq_len,
                                                self.plm_n_layers * 2,
                                                self.plm_n_heads,
                                                self.plm_n_embd)
 
         # past_key_values = self.dropout(past_key_values)
-        past_key_values = past_key_values.permute(2, 0, 3, 1, 4).split(2)
+        # (n_layers * 2, 1, n_heads, prompt_seq_len, n_embd)
+        return past_key_values.permute(2, 0, 3, 1, 4)
+
+    @staticmethod
+    def expand(past_key_values, batch_size, stacked=False):
+        # broadcast the encoded prompt over the batch,
+        # (n_layers * 2, B, n_heads, prompt_seq_len, n_embd)
+        past_key_values = past_key_values.expand(-1, batch_size, -1, -1, -1)
+        if stacked:
+            return past_key_values
 
-        return past_key_values
+        return past_key_values.split(2)
+
+    def forward(self, batch_size, stacked=False):
+        return self.expand(self.encode(), batch_size, stacked)
 
 
 class MultiHeadAttention(nn.Module):
@@ -121,29 +141,43 @@ class MultiHeadAttention(nn.Module):
 
         query_layer = self.transpose_for_scores(mixed_query_layer) \
             .permute(0, 2, 1, 3)
-        key_layer = self.transpose_for_scores(mixed_key_layer) \
-            .permute(0, 2, 3, 1)
         value_layer = self.transpose_for_scores(mixed_value_layer) \
             .permute(0, 2, 1, 3)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer)
+        if hasattr(F, "scaled_dot_product_attention"):
+            # fused attention kernel, the scores are never materialized,
+            # the additive mask already holds the causal and padding parts
+            key_layer = self.transpose_for_scores(mixed_key_layer) \
+                .permute(0, 2, 1, 3)
+            dropout_p = self.attn_dropout.p if self.training else 0.0
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask.type_as(query_layer),
+                dropout_p=dropout_p)
+        else:
+            key_layer = self.transpose_for_scores(mixed_key_layer) \
+                .permute(0, 2, 3, 1)
+
+            # Take the dot product between "query" and "key" to get the raw attention scores.
+            attention_scores = torch.matmul(query_layer, key_layer)
 
-        attention_scores = attention_scores / self.sqrt_attention_head_size
-        # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        # [batch_size heads seq_len seq_len] scores
-        # [batch_size 1 1 seq_len]
-        # attention_scores = attention_scores + attention_mask
-        attention_scores = attention_scores \
-            + attention_mask.type_as(attention_scores)
+            attention_scores = attention_scores / self.sqrt_attention_head_size
+            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+            # [batch_size heads seq_len seq_len] scores
+            # [batch_size 1 1 seq_len]
+            # attention_scores = attention_scores + attention_mask
+            attention_scores = attention_scores \
+                + attention_mask.type_as(attention_scores)
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = self.softmax(attention_scores)
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
+            # Normalize the attention scores to probabilities.
+            attention_probs = self.softmax(attention_scores)
+            # This is actually dropping out entire tokens to attend to, which might
+            # seem a bit unusual, but is taken from the original Transformer paper.
 
-        attention_probs = self.attn_dropout(attention_probs)
-        context_layer = torch.matmul(attention_probs, value_layer)
+            attention_probs = self.attn_dropout(attention_probs)
+            context_layer = torch.matmul(attention_probs, value_layer)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] \
@@ -243,3 +277,56 @@ class TransformerEncoder(nn.Module):
         if not output_all_encoded_layers:
             all_encoder_layers.append(hidden_states)
         return all_encoder_layers
+
+
+class PLMLastHiddenState(nn.Module):
+    """Wrap a huggingface PLM to take positional inputs and return the last
+    hidden state only, e.g. for tracing with `torch.jit.trace`."""
+
+    def __init__(self, plm):
+        super(PLMLastHiddenState, self).__init__()
+        self.plm = plm
+
+    def forward(self, input_ids, attention_mask):
+        output = self.plm(input_ids=input_ids,
+                          attention_mask=attention_mask,
+                          use_cache=False)
+        return output.last_hidden_state
+
+
+class OffloadedEmbedding(nn.Module):
+    """Frozen embedding table kept in CPU memory.
+
+    The lookup runs on CPU into a pinned buffer, and only the looked up
+    embeddings are copied, asynchronously, to the device of the ids. Moving
+    the module, e.g. by `model.to(device)`, only changes the dtype of the
+    table, so it never takes device memory. The weight keeps the name of
+    `nn.Embedding`, so checkpoints are unchanged.
+    """
+
+    def __init__(self, embedding):
+        super(OffloadedEmbedding, self).__init__()
+        self.padding_idx = embedding.padding_idx
+        self.weight = nn.Parameter(embedding.weight.detach().cpu(),
+                                   requires_grad=False)
+
+    def _apply(self, fn, recurse=True):
+        # find the target dtype with an empty tensor, keep the table on cpu
+        dtype = fn(self.weight.data.new_empty(0)).dtype
+        if dtype != self.weight.dtype:
+            self.weight.data = self.weight.data.to(dtype)
+        return self
+
+    def forward(self, input_ids):
+        flat_ids = input_ids.reshape(-1).cpu()
+        if not input_ids.is_cuda:
+            embs = self.weight.index_select(0, flat_ids)
+            return embs.view(*input_ids.shape, -1)
+        # gather straight into pinned memory, so the copy to the gpu does not
+        # block, the pinned blocks are recycled by the host caching allocator
+        embs = torch.empty((flat_ids.shape[0], self.weight.shape[-1]),
+                           dtype=self.weight.dtype,
+                           pin_memory=True)
+        torch.index_select(self.weight, 0, flat_ids, out=embs)
+        embs = embs.to(input_ids.device, non_blocking=True)
+        return embs.view(*input_ids.shape, -1)
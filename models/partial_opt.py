@@ -2,8 +2,8 @@ from transformers.models.opt.modeling_opt import (
     OPTModel, 
     OPTPreTrainedModel,
     OPTDecoderLayer,
+    OPTAttention,
     OPTLearnedPositionalEmbedding,
-    _make_causal_mask,
     _expand_mask,
     OPT_INPUTS_DOCSTRING,
     _CHECKPOINT_FOR_DOC,
@@ -31,6 +31,23 @@ from transformers.models.opt.configuration_opt import OPTConfig
 logger = logging.get_logger(__name__)
 
 
+def _make_causal_mask(input_ids_shape: torch.Size, dtype: torch.dtype, device: torch.device, past_key_values_length: int = 0):
+    """
+    Make causal mask used for bi-directional self-attention.
+
+    Unlike the transformers version, the mask is built on `device` directly, so no host to device copy is needed and
+    the forward can be captured into a CUDA graph.
+    """
+    bsz, tgt_len = input_ids_shape
+    mask = torch.full((tgt_len, tgt_len), torch.finfo(dtype).min, dtype=dtype, device=device)
+    mask_cond = torch.arange(mask.size(-1), device=device)
+    mask.masked_fill_(mask_cond < (mask_cond + 1).view(mask.size(-1), 1), 0)
+
+    if past_key_values_length > 0:
+        mask = torch.cat([torch.zeros(tgt_len, past_key_values_length, dtype=dtype, device=device), mask], dim=-1)
+    return mask[None, None, :, :].expand(bsz, 1, tgt_len, tgt_len + past_key_values_length)
+
+
 def check_keep_decoders_range(
     config: OPTConfig,
     keep_embed_layer: bool,
@@ -67,6 +84,64 @@ def check_keep_decoders_range(
     return (range_start, range_end)
 
 
+class OPTSdpaAttention(OPTAttention):
+    """OPTAttention computed by the fused `scaled_dot_product_attention`
+    kernel, so the (tgt_len, src_len) attention weights of every head are
+    never materialized. It has the same parameters as OPTAttention, and falls
+    back to it when the attention weights or a head mask are requested."""
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        if output_attentions or layer_head_mask is not None or key_value_states is not None:
+            return super().forward(
+                hidden_states=hidden_states,
+                key_value_states=key_value_states,
+                past_key_value=past_key_value,
+                attention_mask=attention_mask,
+                layer_head_mask=layer_head_mask,
+                output_attentions=output_attentions,
+            )
+
+        bsz, tgt_len, _ = hidden_states.size()
+
+        # the kernel applies the 1 / sqrt(head_dim) scaling itself
+        query_states = self._shape(self.q_proj(hidden_states), tgt_len, bsz)
+        key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+        value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+        if past_key_value is not None:
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+
+        if self.is_decoder:
+            past_key_value = (key_states, value_states)
+
+        if attention_mask is not None:
+            # the causal and the padding parts may add up to -inf, clamp them
+            # as the eager attention does, so fully masked rows are not nan
+            attention_mask = attention_mask.to(query_states.dtype).clamp(
+                min=torch.finfo(query_states.dtype).min)
+
+        attn_output = nn.functional.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+        )
+
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, None, past_key_value
+
+
 class PartialOPTDecoder(OPTPreTrainedModel):
     
     def __init__(
@@ -118,7 +193,11 @@ class PartialOPTDecoder(OPTPreTrainedModel):
 
             self.layers = nn.ModuleList()
             for i in range(self.keep_decoders_range[0], self.keep_decoders_range[1]):
-                self.layers.add_module(str(i), OPTDecoderLayer(config))
+                layer = OPTDecoderLayer(config)
+                if hasattr(nn.functional, "scaled_dot_product_attention"):
+                    # same parameters, only the attention kernel differs
+                    layer.self_attn.__class__ = OPTSdpaAttention
+                self.layers.add_module(str(i), layer)
             
         self.gradient_checkpointing = False
         # Initialize weights and apply final processing
@@ -143,8 +222,8 @@ class PartialOPTDecoder(OPTPreTrainedModel):
         combined_attention_mask = None
         if input_shape[-1] > 1:
             combined_attention_mask = _make_causal_mask(
-                input_shape, inputs_embeds.dtype, past_key_values_length=past_key_values_length
-            ).to(inputs_embeds.device)
+                input_shape, inputs_embeds.dtype, inputs_embeds.device, past_key_values_length=past_key_values_length
+            )
 
         if attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
@@ -318,12 +397,15 @@ class PartialOPTDecoder(OPTPreTrainedModel):
 
                     return custom_forward
 
+                # non-reentrant, so the trainable layers above frozen ones,
+                # whose inputs do not require grad, still get gradients
                 layer_outputs = torch.utils.checkpoint.checkpoint(
                     create_custom_forward(decoder_layer),
                     hidden_states,
                     attention_mask,
                     head_mask[idx] if head_mask is not None else None,
                     None,
+                    use_reentrant=False,
                 )
             else:
 
@@ -387,8 +469,13 @@ class PartialOPTModel(OPTModel):
         # Initialize weights and apply final processing
         self.post_init()
 
+    def _set_gradient_checkpointing(self, module, value=False):
+        # the partial decoder is not an OPTDecoder, toggle it here
+        if isinstance(module, PartialOPTDecoder):
+            module.gradient_checkpointing = value
+
     def get_input_embeddings(self):
-        self.decoder.get_input_embeddings()
+        return self.decoder.get_input_embeddings()
 
     def set_input_embeddings(self, value):
         self.decoder.set_input_embeddings(value)
@@ -1,3 +1,4 @@
+import re
 import torch
 from transformers import BertModel
 from utils.pylogger import get_pylogger
@@ -7,10 +8,13 @@ from models.layers import DeepPromptEncoder
 from models.abstract_recommender import TextSeqRec, METRIC_LIST
 
 from models.configs import BERTSeqRecConfig, BERTPromptSeqRecConfig
-from models.utils import mean_pooling, gather_indexes
+from models.utils import (mean_pooling, gather_indexes,
+                          NO_WEIGHT_DECAY_PATTERN)
 
 log = get_pylogger(__name__)
 
+BERT_LAYER_PATTERN = re.compile(r"^encoder\.layer\.(\d+)\.")
+
 
 class BERTSeqRec(TextSeqRec):
 
@@ -18,8 +22,12 @@ class BERTSeqRec(TextSeqRec):
         self.save_hyperparameters()
         super().__init__(self.hparams.config)
 
-        # parameters initialization
-        self.apply(self._init_weights)
+        # parameters initialization, the pretrained bert weights are kept
+        self._init_module_weights(
+            ["projection", "sasrec", "classification_head"])
+
+        if self.hparams.config.use_torch_compile:
+            self._compile_modules()
 
     def _set_plm_model(self, plm_name):
         self.bert = BertModel.from_pretrained(plm_name)
@@ -45,45 +53,49 @@ class BERTSeqRec(TextSeqRec):
             for param in unfreeze_layers.parameters():
                 param.requires_grad = True
 
-    def _feature_extract(self, input_ids, attention_mask):
-        input_ids = input_ids.view(-1, input_ids.shape[-1])
-        attention_mask = attention_mask.view(-1, attention_mask.shape[-1])
+    def _feature_extract(self, input_ids, attention_mask, item_inverse=None):
+        # input_ids and attention_mask are (N_unique, L_plm), flattened and
+        # deduplicated by the dataset collate
         item_embs = self._get_bert_output(input_ids, attention_mask)
-
-        for layer in self.projection:
-            item_embs = layer(item_embs)
+        item_embs = self.projection(item_embs)
+        if item_inverse is not None:
+            # the inputs are the distinct items of the batch, gather them
+            # back to their positions in the sequences
+            item_embs = item_embs[item_inverse]
 
         sasrec_seq_len = self.hparams.config.sasrec_seq_len
         sasrec_hidden_size = self.hparams.config.sasrec_hidden_size
         item_embs = item_embs.view(-1, sasrec_seq_len, sasrec_hidden_size)
         return item_embs
 
-    def forward(self, item_seq_mask, input_ids, attention_mask):
-        item_embs = self._feature_extract(input_ids, attention_mask)
+    def forward(self, item_seq_mask, input_ids, attention_mask,
+                item_inverse=None):
+        item_embs = self._feature_extract(input_ids, attention_mask,
+                                          item_inverse)
         output = self.sasrec(item_embs, item_seq_mask)  # (B, L_sas, H_sas)
         output = self.classification_head(output)
         return output  # (B, L, N_items)
     
     def training_step(self, batch, batch_idx):
-        target_seq, _, item_seq_mask, input_ids, attention_mask = batch
-        seq_emb = self.forward(
-            item_seq_mask, input_ids, attention_mask)  # (B, L, N_items)
-        loss = self.loss_fct(seq_emb.reshape(-1, seq_emb.size(-1)),
-                             target_seq.reshape(-1))
+        target_seq, _, item_seq_mask, _, \
+            input_ids, attention_mask, item_inverse = batch
+        seq_emb = self.forward(item_seq_mask, input_ids, attention_mask,
+                               item_inverse)  # (B, L, N_items)
+        loss = self._compute_loss(seq_emb, target_seq)
         return loss
     
     def _val_test_step(self, batch, batch_idx, stage):
-        target_seq, _, item_seq_mask, input_ids, attention_mask = batch
+        target_seq, _, item_seq_mask, last_item_idx, \
+            input_ids, attention_mask, item_inverse = batch
         
-        seq_emb = self.forward(
-            item_seq_mask, input_ids, attention_mask) # (B, L, N_items)
-        last_item_idx = torch.sum(item_seq_mask, dim=-1) - 1 # (B)
+        seq_emb = self.forward(item_seq_mask, input_ids, attention_mask,
+                               item_inverse) # (B, L, N_items)
         seq_last_emb = gather_indexes(seq_emb, last_item_idx) # (B, N_items)
         last_id = target_seq.gather(1, last_item_idx.view(-1, 1)) # (B, 1)
 
         topk_list = self.hparams.config.topk_list
-        pred_scores = seq_last_emb.softmax(dim=-1)
-        all_ranks = get_topk_ranks(pred_scores=pred_scores,
+        # softmax is monotonic, so rank the logits directly
+        all_ranks = get_topk_ranks(pred_scores=seq_last_emb,
                                    target=last_id,
                                    topk=max(topk_list))
 
@@ -114,61 +126,69 @@ class BERTSeqRec(TextSeqRec):
         return item_embs
 
     def _set_bert_lr(self, lr, layer_decay, weight_decay):
-        tuning_params = []
+        # one group per (lr, weight_decay), instead of one per parameter,
+        # so the optimizer steps a few large groups
+        tuning_params = {}
         n_layers = self.bert.config.num_hidden_layers
         lrs = [lr * (layer_decay**(n_layers - i)) for i in range(n_layers)]
-        no_weight_decay = ["bias", "LayerNorm.weight"]
 
         for name, params in self.bert.named_parameters():
-            if name.startswith("encoder.layer"):
-                layer_idx = int(name.split(".")[2])
-                p = {"params": params, "lr": lrs[layer_idx], "name": name}
+            if not params.requires_grad:
+                continue
+            layer_match = BERT_LAYER_PATTERN.match(name)
+            if layer_match is not None:
+                layer_lr = lrs[int(layer_match.group(1))]
             elif name.startswith("embeddings"):
-                p = {"params": params, "lr": lrs[0], "name": name}
+                layer_lr = lrs[0]
             else:
-                p = {"params": params, "lr": lrs[-1], "name": name}
-            if any(nd in name for nd in no_weight_decay):
-                p.update(weight_decay=0.0)
+                layer_lr = lrs[-1]
+            if NO_WEIGHT_DECAY_PATTERN.search(name):
+                wd = 0.0
             else:
-                p.update(weight_decay=weight_decay)
-            tuning_params.append(p)
-
-        tuning_params = [
-            layer for layer in tuning_params if layer["params"].requires_grad
-        ]
-        return tuning_params
+                wd = weight_decay
+            if (layer_lr, wd) not in tuning_params:
+                tuning_params[(layer_lr, wd)] = {
+                    "params": [],
+                    "lr": layer_lr,
+                    "weight_decay": wd,
+                    "name": f"bert_lr_{layer_lr:.3g}_wd_{wd:.3g}"
+                }
+            tuning_params[(layer_lr, wd)]["params"].append(params)
+        return list(tuning_params.values())
 
     def configure_optimizers(self):
         lr = self.hparams.config.lr
         wd = self.hparams.config.weight_decay
         if self.hparams.config.plm_last_n_unfreeze == 0:
-            optimizer = torch.optim.AdamW(self.parameters(),
-                                          lr=lr,
-                                          weight_decay=wd)
+            optimizer = self._build_adamw(
+                [params for params in self.parameters()
+                 if params.requires_grad],
+                lr=lr,
+                weight_decay=wd)
         else:
             plm_lr = self.hparams.config.plm_lr
             layer_decay = self.hparams.config.plm_lr_layer_decay
             plm_wd = self.hparams.config.plm_weight_decay
             # set different learning rate for different layers
             bert_tuning_params = self._set_bert_lr(plm_lr, layer_decay, plm_wd)
-            bert_tuning_names = [
-                "bert." + layer["name"] for layer in bert_tuning_params
+            # match by tensor identity, an O(1) lookup per parameter
+            bert_tuning_ids = {
+                id(params) for layer in bert_tuning_params
+                for params in layer["params"]
+            }
+            the_rest_params = [
+                params for params in self.parameters()
+                if id(params) not in bert_tuning_ids and params.requires_grad
             ]
-            the_rest_layers = []
-            for name, params in self.named_parameters():
-                if name not in bert_tuning_names:
-                    # if name.startswith("projection"):
-                    #     the_rest_layers.append({"params": params, "lr": 1e-3, "name": name})
-                    # else:
-                    the_rest_layers.append({
-                        "params": params,
-                        "lr": lr,
-                        "weight_decay": wd,
-                        "name": name
-                    })
-
-            all_params = bert_tuning_params + the_rest_layers
-            optimizer = torch.optim.AdamW(all_params)
+            the_rest_params = [{
+                "params": the_rest_params,
+                "lr": lr,
+                "weight_decay": wd,
+                "name": "the_rest"
+            }]
+
+            all_params = bert_tuning_params + the_rest_params
+            optimizer = self._build_adamw(all_params)
             # warmup_type = "linear"
             # if warmup_type is not None:
             #     scheduler = []
@@ -220,16 +240,25 @@ class BERTPromptSeqRec(BERTSeqRec):
             prompt_hidden_size=config.prompt_hidden_size,
             layer_norm_eps=config.layer_norm_eps)
 
-        # parameters initialization
-        self.apply(self._init_weights)
+        # all-ones attention mask of the prompt, grown lazily and sliced
+        self.register_buffer("_prefix_mask_cache", None, persistent=False)
+
+        # parameters initialization, the pretrained bert weights are kept
+        self._init_module_weights([
+            "prefix_encoder", "projection", "sasrec", "classification_head"
+        ])
+
+        if self.hparams.config.use_torch_compile:
+            self._compile_modules()
 
     def _get_bert_output(self, input_ids, attention_mask):
         pre_seq_len = self.hparams.config.pre_seq_len
         plm_batch_size = input_ids.shape[0]
 
         past_key_values = self.prefix_encoder(plm_batch_size)
-        prefix_attention_mask = torch.ones(plm_batch_size,
-                                           pre_seq_len).type_as(attention_mask)
+        prefix_attention_mask = self._get_prompt_mask(
+            "_prefix_mask_cache", plm_batch_size, pre_seq_len,
+            attention_mask)
         prompt_attention_mask = torch.cat(
             (prefix_attention_mask, attention_mask), dim=1)
         output = self.bert(
@@ -28,16 +28,15 @@ class IDSeqRec(SeqRec):
         return item_embs
     
     def _val_test_step(self, batch, batch_idx, stage):
-        target_seq, input_seq, seq_mask, _, _ = batch
+        target_seq, input_seq, seq_mask, last_item_idx, _, _, _ = batch
         
         seq_emb = self.forward(input_seq, seq_mask) # (B, L, N_items)
-        last_item_idx = torch.sum(seq_mask, dim=-1) - 1 # (B)
         seq_last_emb = gather_indexes(seq_emb, last_item_idx) # (B, N_items)
         last_id = target_seq.gather(1, last_item_idx.view(-1, 1)) # (B, 1)
 
         topk_list = self.hparams.config.topk_list
-        pred_scores = seq_last_emb.softmax(dim=-1)
-        all_ranks = get_topk_ranks(pred_scores=pred_scores,
+        # softmax is monotonic, so rank the logits directly
+        all_ranks = get_topk_ranks(pred_scores=seq_last_emb,
                                    target=last_id,
                                    topk=max(topk_list))
 
@@ -53,10 +52,9 @@ class IDSeqRec(SeqRec):
         return output  # (B, L, N_items)
         
     def training_step(self, batch, batch_idx):
-        target_seq, input_seq, seq_mask, _, _ = batch
+        target_seq, input_seq, seq_mask, _, _, _, _ = batch
         seq_emb = self.forward(input_seq, seq_mask)  # (B, L, N_items)
-        loss = self.loss_fct(seq_emb.reshape(-1, seq_emb.size(-1)),
-                             target_seq.reshape(-1))
+        loss = self._compute_loss(seq_emb, target_seq)
         return loss
 
     def configure_optimizers(self):
@@ -1,29 +1,97 @@
+from collections import OrderedDict
 import torch
 from transformers import AutoConfig
+from pytorch_lightning.strategies import SingleDeviceStrategy
 from utils.pylogger import get_pylogger
 from utils.metrics import get_topk_ranks
 from utils.schedule_functions import get_lr_scheduler_function
-from models.layers import PromptEncoder, DeepPromptEncoder
+from models.layers import (PromptEncoder, DeepPromptEncoder,
+                           PLMLastHiddenState, OffloadedEmbedding)
 from models.partial_opt import PartialOPTModel
 from models.abstract_recommender import TextSeqRec, METRIC_LIST
 from models.configs import OPTSeqRecConfig, OPTPromptSeqRecConfig
-from models.utils import mean_pooling, last_pooling, gather_indexes
+from models.utils import (mean_pooling, last_pooling, gather_indexes,
+                          CUDAGraphRunner, NO_WEIGHT_DECAY_PATTERN)
+from utils.cli_parse import parse_boolean
 
 log = get_pylogger(__name__)
 
+# at most this many traced PLMs are kept, each holds its own folded weights
+MAX_JIT_OPT_MODULES = 8
+
 
 class OPTSeqRec(TextSeqRec):
     def __init__(self, config: OPTSeqRecConfig):
         self.save_hyperparameters()
         super().__init__(self.hparams.config)
 
-        # parameters initialization
-        self.apply(self._init_weights)
+        # cuda graphs of the frozen PLM, keyed by the padded batch size,
+        # all graphs share the input buffers and the memory pool
+        self._cuda_graph_runners = {}
+        self._cuda_graph_inputs = None
+        self._cuda_graph_pool = None
+        # set when a capture fails, the PLM then runs in eager mode
+        self._cuda_graph_failed = False
+        # traced frozen PLM, keyed by the padded input shape and the autocast
+        # dtype, the least recently used ones are evicted
+        self._jit_opt_modules = OrderedDict()
+        # hooks stepping the opt parameters in backward, if enabled
+        self._step_in_backward_handles = []
+
+        # pooled embeddings of all items from the frozen PLM, built once per
+        # run from the item texts of the datamodule, see _build_item_cache
+        self.register_buffer("_item_cache", None, persistent=False)
+
+        # parameters initialization, the pretrained opt weights are kept
+        self._init_module_weights(
+            ["projection", "sasrec", "classification_head"])
+
+        if self.hparams.config.plm_gradient_checkpointing \
+                and self.hparams.config.plm_last_n_unfreeze != 0:
+            # recompute the opt activations in backward instead of keeping
+            # them, the kv cache is useless then
+            self.opt.config.use_cache = False
+            self.opt.gradient_checkpointing_enable()
+
+        if self.hparams.config.use_torch_compile:
+            self._compile_modules()
+
+    def _compile_modules(self):
+        if not super()._compile_modules():
+            return False
+        # the pooling is a memory bound reduction over the whole plm output,
+        # let the mask cast and the normalization fuse into it, its shapes are
+        # left dynamic as the number of items changes every step
+        self._pool_opt_output = torch.compile(self._pool_opt_output,
+                                              fullgraph=True)
+        return True
 
     def _set_plm_model(self, plm_name):
         self.opt = PartialOPTModel.from_pretrained(plm_name,
                                                    keep_embed_layer=True,
                                                    keep_decoders_range=(0, -1))
+        if self._use_frozen_bf16():
+            self.opt.to(dtype=torch.bfloat16)
+        if getattr(self.hparams.config, "plm_offload_embeddings", False):
+            # the frozen token embeddings are only gathered once per token,
+            # keep the table in host memory instead of on the gpu
+            decoder = self.opt.decoder
+            decoder.embed_tokens = OffloadedEmbedding(decoder.embed_tokens)
+
+    def _use_bf16(self):
+        if not getattr(self.hparams.config, "plm_bf16", False):
+            return False
+        if not hasattr(self, "_bf16_supported"):
+            self._bf16_supported = not torch.cuda.is_available() \
+                or torch.cuda.is_bf16_supported()
+            if not self._bf16_supported:
+                log.warning("bf16 is not supported by the GPU, plm_bf16 is "
+                            "ignored.")
+        return self._bf16_supported
+
+    def _use_frozen_bf16(self):
+        return self._use_bf16() \
+            and self.hparams.config.plm_last_n_unfreeze == 0
 
     def _get_item_emb_dim(self):
         return self.opt.config.hidden_size
@@ -46,45 +114,141 @@ class OPTSeqRec(TextSeqRec):
             for param in unfreeze_layers.parameters():
                 param.requires_grad = True
 
-    def _feature_extract(self, input_ids, attention_mask):
-        input_ids = input_ids.view(-1, input_ids.shape[-1])
-        attention_mask = attention_mask.view(-1, attention_mask.shape[-1])
-        item_embs = self._get_opt_output(input_ids, attention_mask)
-
-        for layer in self.projection:
-            item_embs = layer(item_embs)
+        if self._keep_plm_eval():
+            self.opt.eval()
+
+    def _keep_plm_eval(self):
+        # a fully frozen opt only runs inference, dropout is never wanted
+        return self.opt is not None \
+            and self.hparams.config.plm_last_n_unfreeze == 0
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self._keep_plm_eval():
+            self.opt.eval()
+        return self
+
+    def _use_item_cache(self):
+        config = self.hparams.config
+        return getattr(config, "plm_item_cache", False) \
+            and config.plm_last_n_unfreeze == 0
+
+    @torch.no_grad()
+    def _build_item_cache(self):
+        if not self._use_item_cache() or self._item_cache is not None:
+            return
+        datamodule = self.trainer.datamodule
+        item_dataset = next(
+            dataset for dataset in (datamodule.data_train,
+                                    datamodule.data_val,
+                                    datamodule.data_test)
+            if dataset is not None)
+        # (N_items, L_plm), the item texts are shared by all the splits
+        tokenized_ids = torch.from_numpy(item_dataset.tokenized_ids)
+        attention_mask = torch.from_numpy(item_dataset.attention_mask)
+        # as many items as a training batch feeds the PLM
+        chunk_size = datamodule.hparams.dm_config.batch_size \
+            * self.hparams.config.sasrec_seq_len
+        log.info(f"Caching the PLM embeddings of {len(tokenized_ids)} items.")
+
+        opt_training = self.opt.training
+        self.opt.eval()
+        item_cache = []
+        with self.trainer.precision_plugin.forward_context():
+            for start in range(0, len(tokenized_ids), chunk_size):
+                input_ids = tokenized_ids[start:start + chunk_size] \
+                    .to(self.device, non_blocking=True)
+                mask = attention_mask[start:start + chunk_size] \
+                    .to(self.device, non_blocking=True)
+                item_cache.append(self._get_item_plm_embs(input_ids, mask))
+        self.opt.train(opt_training)
+        self._item_cache = torch.cat(item_cache)  # (N_items, H_plm)
+
+    def setup(self, stage=None):
+        # called before the strategy wraps the model, the offloaded cpu table
+        # can not be broadcast or sharded across devices
+        if getattr(self.hparams.config, "plm_offload_embeddings", False) \
+                and (self.trainer.world_size > 1 or not isinstance(
+                    self.trainer.strategy, SingleDeviceStrategy)):
+            raise ValueError(
+                "plm_offload_embeddings only supports a single device, "
+                "please disable it for distributed training.")
+        if self._use_item_cache():
+            # the items are looked up in the cache, skip gathering their
+            # tokens in the collate
+            datamodule = self.trainer.datamodule
+            for dataset in (datamodule.data_train, datamodule.data_val,
+                            datamodule.data_test):
+                if dataset is not None:
+                    dataset.with_tokens = False
+
+    def on_fit_start(self):
+        self._build_item_cache()
+
+    def on_validation_start(self):
+        self._build_item_cache()
+
+    def on_test_start(self):
+        self._build_item_cache()
+
+    def _feature_extract(self, input_ids, attention_mask, item_inverse=None,
+                         item_id_seq=None):
+        # the prompt models skip OPTSeqRec.__init__ and have no item cache,
+        # _use_item_cache is false for them
+        if item_id_seq is not None and self._use_item_cache() \
+                and self._item_cache is not None:
+            # frozen PLM, look up the cached embeddings of the items
+            item_embs = self._item_cache[item_id_seq]  # (B, L_sas, H_plm)
+            return self.projection(item_embs)
+
+        # input_ids and attention_mask are (N_unique, L_plm), flattened and
+        # deduplicated by the dataset collate
+        # bf16 activations for the opt and the projection, the weights of a
+        # trained opt stay in fp32
+        with torch.autocast(device_type=input_ids.device.type,
+                            dtype=torch.bfloat16,
+                            enabled=self._use_bf16()):
+            item_embs = self._get_item_plm_embs(input_ids, attention_mask)
+            item_embs = self.projection(item_embs)
+        if item_inverse is not None:
+            # the inputs are the distinct items of the batch, gather them
+            # back to their positions in the sequences
+            item_embs = item_embs[item_inverse]
 
         sasrec_seq_len = self.hparams.config.sasrec_seq_len
         sasrec_hidden_size = self.hparams.config.sasrec_hidden_size
         item_embs = item_embs.view(-1, sasrec_seq_len, sasrec_hidden_size)
         return item_embs
 
-    def forward(self, item_seq_mask, input_ids, attention_mask):
-        item_embs = self._feature_extract(input_ids, attention_mask)
+    def forward(self, item_seq_mask, input_ids, attention_mask,
+                item_inverse=None, item_id_seq=None):
+        item_embs = self._feature_extract(input_ids, attention_mask,
+                                          item_inverse, item_id_seq)
         output = self.sasrec(item_embs, item_seq_mask)  # (B, L_sas, H_sas)
         output = self.classification_head(output)
         return output  # (B, L, N_items)
 
     def training_step(self, batch, batch_idx):
-        target_seq, _, item_seq_mask, input_ids, attention_mask = batch
-        seq_emb = self.forward(item_seq_mask, input_ids,
-                               attention_mask)  # (B, L, N_items)
-        loss = self.loss_fct(seq_emb.reshape(-1, seq_emb.size(-1)),
-                             target_seq.reshape(-1))
+        target_seq, item_id_seq, item_seq_mask, _, \
+            input_ids, attention_mask, item_inverse = batch
+        seq_emb = self.forward(item_seq_mask, input_ids, attention_mask,
+                               item_inverse, item_id_seq)  # (B, L, N_items)
+        loss = self._compute_loss(seq_emb, target_seq)
         return loss
 
     def _val_test_step(self, batch, batch_idx, stage):
-        target_seq, _, item_seq_mask, input_ids, attention_mask = batch
+        target_seq, item_id_seq, item_seq_mask, last_item_idx, \
+            input_ids, attention_mask, item_inverse = batch
         
         # (B, L, N_items)
-        seq_emb = self.forward(item_seq_mask, input_ids, attention_mask)  
-        last_item_idx = torch.sum(item_seq_mask, dim=-1) - 1  # (B)
+        seq_emb = self.forward(item_seq_mask, input_ids, attention_mask,
+                               item_inverse, item_id_seq)
         seq_last_emb = gather_indexes(seq_emb, last_item_idx)  # (B, N_items)
         last_id = target_seq.gather(1, last_item_idx.view(-1, 1))  # (B, 1)
 
         topk_list = self.hparams.config.topk_list
-        pred_scores = seq_last_emb.softmax(dim=-1)
-        all_ranks = get_topk_ranks(pred_scores=pred_scores,
+        # softmax is monotonic, so rank the logits directly
+        all_ranks = get_topk_ranks(pred_scores=seq_last_emb,
                                    target=last_id,
                                    topk=max(topk_list))
 
@@ -93,16 +257,158 @@ class OPTSeqRec(TextSeqRec):
                 metric = self.topk_metric[f"{metric_name}@{k}"]
                 metric.update(all_ranks, last_id.numel())
 
+    def _opt_last_hidden_state(self, input_ids, attention_mask):
+        output = self.opt(input_ids=input_ids,
+                          attention_mask=attention_mask,
+                          use_cache=False)
+        return output.last_hidden_state
+
+    def _get_cuda_graph_capture_size(self, batch_size):
+        for capture_size in self.hparams.config.cuda_graph_capture_sizes:
+            if capture_size >= batch_size:
+                return capture_size
+        return None
+
+    def _cuda_graph_opt_forward(self, input_ids, attention_mask,
+                                capture_size):
+        batch_size, seq_len = input_ids.shape
+        if self._cuda_graph_inputs is None or \
+                self._cuda_graph_inputs[0].shape[-1] != seq_len:
+            # (re)allocate the shared input buffers at the max capture size,
+            # the padded rows are independent of the real ones in OPT
+            max_size = self.hparams.config.cuda_graph_capture_sizes[-1]
+            pad_token_id = self.opt.config.pad_token_id
+            static_ids = torch.full((max_size, seq_len),
+                                    pad_token_id,
+                                    dtype=input_ids.dtype,
+                                    device=input_ids.device)
+            static_mask = torch.zeros((max_size, seq_len),
+                                      dtype=attention_mask.dtype,
+                                      device=attention_mask.device)
+            self._cuda_graph_inputs = (static_ids, static_mask)
+            self._cuda_graph_runners = {}
+            self._cuda_graph_pool = torch.cuda.graph_pool_handle()
+
+        static_ids, static_mask = self._cuda_graph_inputs
+        static_ids[:batch_size].copy_(input_ids)
+        static_mask[:batch_size].copy_(attention_mask)
+
+        if capture_size not in self._cuda_graph_runners:
+            self._cuda_graph_runners[capture_size] = CUDAGraphRunner(
+                forward_fn=self._opt_last_hidden_state,
+                static_inputs=(static_ids[:capture_size],
+                               static_mask[:capture_size]),
+                pool=self._cuda_graph_pool)
+        runner = self._cuda_graph_runners[capture_size]
+        try:
+            return runner.replay()[:batch_size]
+        except RuntimeError as e:
+            log.warning(f"Failed to capture the OPT model into a CUDA graph, "
+                        f"running in eager mode: {e}")
+            self._cuda_graph_failed = True
+            self._cuda_graph_runners = {}
+            self._cuda_graph_inputs = None
+            return self._opt_last_hidden_state(input_ids, attention_mask)
+
+    def _jit_opt_forward(self, input_ids, attention_mask):
+        # the number of distinct items changes every batch, pad it to the
+        # nearest capture size, so only a few shapes are traced
+        batch_size = input_ids.shape[0]
+        pad_size = self._get_cuda_graph_capture_size(batch_size)
+        if pad_size is not None and pad_size > batch_size:
+            n_pad = pad_size - batch_size
+            pad_token_id = self.opt.config.pad_token_id
+            input_ids = torch.cat(
+                (input_ids,
+                 input_ids.new_full((n_pad, input_ids.shape[1]),
+                                    pad_token_id)))
+            attention_mask = torch.cat(
+                (attention_mask,
+                 attention_mask.new_zeros((n_pad, attention_mask.shape[1]))))
+
+        autocast_dtype = None
+        if torch.is_autocast_enabled():
+            autocast_dtype = torch.get_autocast_gpu_dtype()
+        key = (tuple(input_ids.shape), input_ids.device, autocast_dtype)
+        if key in self._jit_opt_modules:
+            self._jit_opt_modules.move_to_end(key)
+        else:
+            if len(self._jit_opt_modules) >= MAX_JIT_OPT_MODULES:
+                self._jit_opt_modules.popitem(last=False)
+            try:
+                # the opt is frozen, so its weights can be folded in
+                traced_opt = torch.jit.trace(
+                    PLMLastHiddenState(self.opt).eval(),
+                    (input_ids, attention_mask),
+                    check_trace=False)
+                self._jit_opt_modules[key] = \
+                    torch.jit.optimize_for_inference(traced_opt)
+            except Exception as e:
+                log.warning(f"Failed to trace the OPT model, running in "
+                            f"eager mode: {e}")
+                self._jit_opt_modules[key] = self._opt_last_hidden_state
+        output = self._jit_opt_modules[key](input_ids, attention_mask)
+        return output[:batch_size]
+
+    def _frozen_opt_forward(self, input_ids, attention_mask):
+        if self.hparams.config.use_cuda_graph and input_ids.is_cuda \
+                and not self._cuda_graph_failed:
+            capture_size = self._get_cuda_graph_capture_size(
+                input_ids.shape[0])
+            if capture_size is not None:
+                return self._cuda_graph_opt_forward(input_ids,
+                                                    attention_mask,
+                                                    capture_size)
+        if self.hparams.config.plm_jit:
+            return self._jit_opt_forward(input_ids, attention_mask)
+        return self._opt_last_hidden_state(input_ids, attention_mask)
+
+    def _get_item_plm_embs(self, input_ids, attention_mask):
+        if not getattr(self.hparams.config, "plm_length_bucketing", False):
+            return self._get_opt_output(input_ids, attention_mask)
+
+        # group the items by their length rounded up to the bucket size and
+        # run each group trimmed to it, the texts are right padded
+        bucket_size = self.hparams.config.plm_bucket_size
+        lens = attention_mask.sum(dim=-1).clamp(min=1)
+        bucket_lens = torch.div(lens + bucket_size - 1,
+                                bucket_size,
+                                rounding_mode="floor") * bucket_size
+        bucket_lens = bucket_lens.clamp(max=input_ids.shape[-1])
+
+        item_embs = None
+        for bucket_len in bucket_lens.unique().tolist():
+            idx = torch.nonzero(bucket_lens == bucket_len, as_tuple=True)[0]
+            bucket_embs = self._get_opt_output(
+                input_ids[idx, :bucket_len], attention_mask[idx, :bucket_len])
+            if item_embs is None:
+                item_embs = bucket_embs.new_empty(
+                    (input_ids.shape[0], bucket_embs.shape[-1]))
+            item_embs[idx] = bucket_embs
+        return item_embs  # (B * L_sas, H_plm)
+
     def _get_opt_output(self, input_ids, attention_mask):
+        # (B * L_sas, L_plm, H_plm)
         if self.hparams.config.plm_last_n_unfreeze == 0:
-            with torch.no_grad():
-                output = self.opt(input_ids=input_ids,
-                                  attention_mask=attention_mask)
+            with torch.inference_mode(), torch.autocast(
+                    device_type=input_ids.device.type,
+                    dtype=torch.bfloat16,
+                    enabled=self._use_frozen_bf16()):
+                sentence_embs = self._frozen_opt_forward(
+                    input_ids, attention_mask)
+                item_embs = self._pool_opt_output(sentence_embs,
+                                                  attention_mask)
+            # inference tensors cannot be saved for backward, always copy
+            # them out, .float() returns the same tensor when the pooling
+            # already ran in fp32. The projection layers are kept in fp32.
+            item_embs = item_embs.to(torch.float32, copy=True)
         else:
-            output = self.opt(input_ids=input_ids,
-                              attention_mask=attention_mask)
-        # (B * L_sas, L_plm, H_plm)
-        sentence_embs = output.last_hidden_state
+            sentence_embs = self._opt_last_hidden_state(
+                input_ids, attention_mask)
+            item_embs = self._pool_opt_output(sentence_embs, attention_mask)
+        return item_embs
+
+    def _pool_opt_output(self, sentence_embs, attention_mask):
         pooling_method = self.hparams.config.pooling_method
         if pooling_method == "mean":  # (B * L_sas, H_plm)
             item_embs = mean_pooling(sentence_embs, attention_mask)
@@ -111,60 +417,121 @@ class OPTSeqRec(TextSeqRec):
         return item_embs
 
     def _set_opt_lr(self, lr, layer_decay, weight_decay):
-        tuning_params = []
+        # one group per (lr, weight_decay), instead of one per parameter,
+        # so the optimizer steps a few large groups
+        tuning_params = {}
         n_layers = self.opt.config.num_hidden_layers
         lrs = [lr * (layer_decay**(n_layers - i)) for i in range(n_layers)]
-        no_weight_decay = ["bias", "LayerNorm.weight"]
-
-        for name, params in self.opt.named_parameters():
-            if name.startswith("decoder.layers"):
-                layer_idx = int(name.split(".")[2])
-                p = {"params": params, "lr": lrs[layer_idx], "name": name}
-            elif name.startswith("decoder.embed_"):
-                p = {"params": params, "lr": lrs[0], "name": name}
-            else:
-                p = {"params": params, "lr": lrs[-1], "name": name}
-            if any(nd in name for nd in no_weight_decay):
-                p.update(weight_decay=0.0)
-            else:
-                p.update(weight_decay=weight_decay)
-            tuning_params.append(p)
 
-        tuning_params = [
-            layer for layer in tuning_params if layer["params"].requires_grad
-        ]
-        return tuning_params
+        def add_params(module, prefix, layer_lr):
+            for name, params in module.named_parameters(prefix=prefix):
+                if not params.requires_grad:
+                    continue
+                if NO_WEIGHT_DECAY_PATTERN.search(name):
+                    wd = 0.0
+                else:
+                    wd = weight_decay
+                if (layer_lr, wd) not in tuning_params:
+                    tuning_params[(layer_lr, wd)] = {
+                        "params": [],
+                        "lr": layer_lr,
+                        "weight_decay": wd,
+                        "name": f"opt_lr_{layer_lr:.3g}_wd_{wd:.3g}"
+                    }
+                tuning_params[(layer_lr, wd)]["params"].append(params)
+
+        for child_name, child in self.opt.decoder.named_children():
+            prefix = f"decoder.{child_name}"
+            if child_name == "layers":
+                # layers keep their original index as name
+                for layer_idx, layer in child.named_children():
+                    add_params(layer, f"{prefix}.{layer_idx}",
+                               lrs[int(layer_idx)])
+            elif child_name.startswith("embed_"):
+                add_params(child, prefix, lrs[0])
+            else:
+                add_params(child, prefix, lrs[-1])
+        return list(tuning_params.values())
 
     def configure_optimizers(self):
         lr = self.hparams.config.lr
         wd = self.hparams.config.weight_decay
         if self.hparams.config.plm_last_n_unfreeze == 0:
-            optimizer = torch.optim.AdamW(self.parameters(),
-                                          lr=lr,
-                                          weight_decay=wd)
+            optimizer = self._build_adamw(
+                [params for params in self.parameters()
+                 if params.requires_grad],
+                lr=lr,
+                weight_decay=wd)
         else:
             plm_lr = self.hparams.config.plm_lr
             layer_decay = self.hparams.config.plm_lr_layer_decay
             plm_wd = self.hparams.config.plm_weight_decay
             # set different learning rate for different layers
             opt_tuning_params = self._set_opt_lr(plm_lr, layer_decay, plm_wd)
-            opt_tuning_names = [
-                "opt." + layer["name"] for layer in opt_tuning_params
+            # match by tensor identity, an O(1) lookup per parameter
+            opt_tuning_ids = {
+                id(params) for layer in opt_tuning_params
+                for params in layer["params"]
+            }
+            the_rest_params = [
+                params for params in self.parameters()
+                if id(params) not in opt_tuning_ids and params.requires_grad
             ]
-            the_rest_params = []
-            for name, params in self.named_parameters():
-                if name not in opt_tuning_names:
-                    the_rest_params.append(params)
             the_rest_params = [{
                 "params": the_rest_params,
                 "lr": lr,
                 "weight_decay": wd,
                 "name": "the_rest"
             }]
+            if self._register_step_in_backward(opt_tuning_params):
+                # the opt parameters are stepped by their own optimizers
+                opt_tuning_params = []
             all_params = opt_tuning_params + the_rest_params
-            optimizer = torch.optim.AdamW(all_params)
+            optimizer = self._build_adamw(all_params)
         return optimizer
 
+    def _register_step_in_backward(self, opt_tuning_params):
+        """Step each opt parameter as soon as its gradient is accumulated in
+        backward and free the gradient, so the gradients of all the opt
+        parameters are never alive at the same time."""
+        for handle in getattr(self, "_step_in_backward_handles", []):
+            handle.remove()
+        self._step_in_backward_handles = []
+        if not getattr(self.hparams.config, "plm_step_in_backward", False):
+            return False
+        if not hasattr(torch.Tensor, "register_post_accumulate_grad_hook"):
+            log.warning(f"Stepping in backward needs torch >= 2.1, got "
+                        f"{torch.__version__}, using a single optimizer.")
+            return False
+        if getattr(self.trainer.precision_plugin, "scaler", None) is not None \
+                or self.trainer.accumulate_grad_batches > 1:
+            log.warning("Stepping in backward does not support fp16 grad "
+                        "scaling or gradient accumulation, "
+                        "using a single optimizer.")
+            return False
+        if self.trainer.world_size > 1 or \
+                not isinstance(self.trainer.strategy, SingleDeviceStrategy):
+            # the hooks would step on the local gradients before they are
+            # all-reduced (or sharded), and the replicas would diverge
+            log.warning("Stepping in backward only supports training on a "
+                        "single device, using a single optimizer.")
+            return False
+
+        def step_hook(params):
+            optimizer = params._optimizer_in_backward
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        for layer in opt_tuning_params:
+            for params in layer["params"]:
+                params._optimizer_in_backward = self._build_adamw(
+                    [params],
+                    lr=layer["lr"],
+                    weight_decay=layer["weight_decay"])
+                self._step_in_backward_handles.append(
+                    params.register_post_accumulate_grad_hook(step_hook))
+        return True
+
     @classmethod
     def add_model_specific_args(cls, parent_parser):
         parser = super(OPTSeqRec, cls).add_model_specific_args(parent_parser)
@@ -175,6 +542,32 @@ class OPTSeqRec(TextSeqRec):
         parser.add_argument("--plm_lr_layer_decay", type=float, default=0.8)
         parser.add_argument("--plm_weight_decay", type=float, default=0.0)
         parser.add_argument("--pooling_method", type=str, default="mean")
+        parser.add_argument("--plm_bf16", type=parse_boolean, default=False)
+        parser.add_argument("--plm_item_cache",
+                            type=parse_boolean,
+                            default=True)
+        parser.add_argument("--plm_jit", type=parse_boolean, default=False)
+        parser.add_argument("--plm_length_bucketing",
+                            type=parse_boolean,
+                            default=False)
+        parser.add_argument("--plm_bucket_size", type=int, default=16)
+        parser.add_argument("--plm_gradient_checkpointing",
+                            type=parse_boolean,
+                            default=False)
+        parser.add_argument("--plm_step_in_backward",
+                            type=parse_boolean,
+                            default=False)
+        parser.add_argument("--plm_offload_embeddings",
+                            type=parse_boolean,
+                            default=False)
+        parser.add_argument("--use_cuda_graph",
+                            type=parse_boolean,
+                            default=False)
+        parser.add_argument(
+            "--cuda_graph_capture_sizes",
+            type=int,
+            nargs="+",
+            default=[1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048])
         return parent_parser
 
     @classmethod
@@ -188,6 +581,16 @@ class OPTSeqRec(TextSeqRec):
             projection_n_layers=args.projection_n_layers,
             projection_inner_sizes=args.projection_inner_sizes,
             pooling_method=args.pooling_method,
+            plm_bf16=args.plm_bf16,
+            plm_item_cache=args.plm_item_cache,
+            plm_jit=args.plm_jit,
+            plm_length_bucketing=args.plm_length_bucketing,
+            plm_bucket_size=args.plm_bucket_size,
+            plm_gradient_checkpointing=args.plm_gradient_checkpointing,
+            plm_step_in_backward=args.plm_step_in_backward,
+            plm_offload_embeddings=args.plm_offload_embeddings,
+            use_cuda_graph=args.use_cuda_graph,
+            cuda_graph_capture_sizes=args.cuda_graph_capture_sizes,
         )
         config = super(OPTSeqRec, cls).build_model_config(args, config)
         return config
@@ -231,60 +634,138 @@ class OPTPromptSeqRec(OPTSeqRec):
                 torch.nn.Linear(plm_hidden_size, plm_hidden_size),
                 torch.nn.LayerNorm(plm_hidden_size, eps=eps))
 
-        # parameters initialization
-        self.apply(self._init_weights)
+        # all-ones attention masks of the prompts, grown lazily and sliced
+        self.register_buffer("_prefix_mask_cache", None, persistent=False)
+        self.register_buffer("_postfix_mask_cache", None, persistent=False)
+        # unexpanded prompt encoder outputs are input independent, reused
+        # for every batch size in eval mode
+        self._eval_prompt_cache = {}
+
+        # parameters initialization, the pretrained opt weights are kept
+        self._init_module_weights([
+            "prefix_encoder", "postfix_encoder", "last_query_encoder",
+            "fusion_mlp", "projection", "sasrec", "classification_head"
+        ])
+
+        if self.hparams.config.use_torch_compile:
+            self._compile_modules()
+
+    def _keep_plm_eval(self):
+        # the prompts are trained through the opt forward
+        return False
+
+    def _compile_modules(self):
+        if not super()._compile_modules():
+            return False
+        if getattr(self, "fusion_mlp", None) is not None:
+            # dynamic batch dim, like the projection
+            self.fusion_mlp.forward = torch.compile(self.fusion_mlp.forward,
+                                                    fullgraph=True)
+        return True
+
+    def train(self, mode=True):
+        # the prompt encoders are updated in training, drop the stale outputs
+        self._eval_prompt_cache.clear()
+        return super().train(mode)
+
+    def load_state_dict(self, state_dict, strict=True):
+        # the loaded prompt encoder weights invalidate the cached outputs
+        self._eval_prompt_cache.clear()
+        return super().load_state_dict(state_dict, strict)
+
+    def _get_prompt(self, encoder_name, batch_size, **kwargs):
+        encoder = getattr(self, encoder_name)
+        if self.training:
+            return encoder(batch_size, **kwargs)
+        if encoder_name not in self._eval_prompt_cache:
+            self._eval_prompt_cache[encoder_name] = encoder.encode()
+        return encoder.expand(self._eval_prompt_cache[encoder_name],
+                              batch_size, **kwargs)
 
     def _get_opt_output(self, input_ids, attention_mask):
         pre_seq_len = self.hparams.config.pre_seq_len
         post_seq_len = self.hparams.config.post_seq_len
         last_query_len = self.hparams.config.last_query_len
+        pooling_method = self.hparams.config.pooling_method
         plm_batch_size = input_ids.shape[0]
+        # the last query forward is only needed by the last token pooling
+        query_last_token = last_query_len > 0 and \
+            pooling_method in ("last", "mean_last")
+        # without a postfix prompt, the last query directly follows the
+        # (right padded) text, so both go through a single opt forward
+        fold_last_query = query_last_token and post_seq_len == 0
+
+        if fold_last_query:
+            last_query_embs = self._get_prompt("last_query_encoder",
+                                               plm_batch_size)
+            text_embs = self.opt.get_input_embeddings()(input_ids)
+            opt_inputs = {
+                "inputs_embeds": torch.cat((text_embs, last_query_embs),
+                                           dim=1)
+            }
+            last_query_attention_mask = self._get_prompt_mask(
+                "_postfix_mask_cache", plm_batch_size, last_query_len,
+                attention_mask)
+            input_attention_mask = torch.cat(
+                (attention_mask, last_query_attention_mask), dim=1)
+        else:
+            opt_inputs = {"input_ids": input_ids}
+            input_attention_mask = attention_mask
 
         if pre_seq_len > 0:
-            past_key_values = self.prefix_encoder(plm_batch_size)
-            prefix_attention_mask = torch.ones(
-                plm_batch_size, pre_seq_len).type_as(attention_mask)
+            past_key_values = self._get_prompt("prefix_encoder",
+                                               plm_batch_size)
+            prefix_attention_mask = self._get_prompt_mask(
+                "_prefix_mask_cache", plm_batch_size, pre_seq_len,
+                attention_mask)
             prompt_attention_mask = torch.cat(
-                (prefix_attention_mask, attention_mask), dim=1)
+                (prefix_attention_mask, input_attention_mask), dim=1)
             output = self.opt(
-                input_ids=input_ids,
+                **opt_inputs,
                 attention_mask=prompt_attention_mask,
                 past_key_values=past_key_values,
+                use_cache=query_last_token and not fold_last_query,
             )
         else:
-            output = self.opt(input_ids=input_ids,
-                              attention_mask=attention_mask)
-            prompt_attention_mask = attention_mask
+            output = self.opt(
+                **opt_inputs,
+                attention_mask=input_attention_mask,
+                use_cache=query_last_token and not fold_last_query)
+            prompt_attention_mask = input_attention_mask
         past_key_values = output.past_key_values
 
-        if last_query_len > 0:
+        if fold_last_query:
+            last_token_embs = output
+        elif query_last_token:
             if post_seq_len > 0:
-                prompt_key_values = self.postfix_encoder(plm_batch_size)
-                new_past_key_values = []
-                for past_key_value, prompt_key_value in zip(
-                        past_key_values, prompt_key_values):
-                    key_states = torch.cat(
-                        (past_key_value[0], prompt_key_value[0]), dim=2)
-                    values_states = torch.cat(
-                        (past_key_value[1], prompt_key_value[1]), dim=2)
-                    new_past_key_values.append((key_states, values_states))
-                past_key_values = new_past_key_values
-
-            post_fix_attention_mask = torch.ones(
-                plm_batch_size,
-                post_seq_len + last_query_len).type_as(attention_mask)
+                # concat the keys and values of all layers in one kernel,
+                # (n_layers * 2, B, n_heads, seq_len, n_embd)
+                prompt_key_values = self._get_prompt("postfix_encoder",
+                                                     plm_batch_size,
+                                                     stacked=True)
+                past_key_values = torch.stack([
+                    states for layer_states in past_key_values
+                    for states in layer_states
+                ])
+                past_key_values = torch.cat(
+                    (past_key_values, prompt_key_values), dim=3).split(2)
+
+            post_fix_attention_mask = self._get_prompt_mask(
+                "_postfix_mask_cache", plm_batch_size,
+                post_seq_len + last_query_len, attention_mask)
             prompt_attention_mask = torch.cat(
                 (prompt_attention_mask, post_fix_attention_mask), dim=1)
 
-            last_query_embs = self.last_query_encoder(plm_batch_size)
+            last_query_embs = self._get_prompt("last_query_encoder",
+                                               plm_batch_size)
             last_token_embs = self.opt(
                 inputs_embeds=last_query_embs,
                 attention_mask=prompt_attention_mask,
                 past_key_values=past_key_values,
             )
 
-        sentence_embs = output.last_hidden_state  # (B * L_sas, L_plm, H_plm)
-        pooling_method = self.hparams.config.pooling_method
+        # (B * L_sas, L_plm, H_plm)
+        sentence_embs = output.last_hidden_state[:, :input_ids.shape[1]]
         if pooling_method == "mean":
             # (B * L_sas, H_plm)
             item_embs = mean_pooling(sentence_embs, attention_mask)
@@ -359,6 +840,10 @@ class PreInferOPTSeqRec(OPTSeqRec):
     def _freeze_plm_layers(self, last_n_unfreeze):
         pass
 
+    def _use_item_cache(self):
+        # the pre-inference datamodules already provide the plm outputs
+        return False
+
     def _get_opt_output(self, attention_mask, inputs_hidden_state):
         output = self.opt(inputs_hidden_state=inputs_hidden_state,
                             attention_mask=attention_mask)
@@ -377,15 +862,16 @@ class PreInferOPTSeqRec(OPTSeqRec):
         attention_mask = None,
         item_embs = None,
         ):
+        # the pre-inferenced embs may be stored in bf16
         if item_embs is None:
-            embs_shape = inputs_hidden_state.shape
-            inputs_hidden_state = inputs_hidden_state. \
-                view(-1, embs_shape[-2], embs_shape[-1]) # (B * L_sas, L_plm, H_plm)
-            attention_mask = attention_mask.view(-1, attention_mask.shape[-1])
-            item_embs = self._get_opt_output(inputs_hidden_state, attention_mask)
+            # (B * L_sas, L_plm, H_plm), flattened by the dataset collate
+            inputs_hidden_state = inputs_hidden_state.float()
+            item_embs = self._get_opt_output(attention_mask,
+                                             inputs_hidden_state)
+        else:
+            item_embs = item_embs.float()
 
-        for layer in self.projection:
-            item_embs = layer(item_embs)
+        item_embs = self.projection(item_embs)
 
         sasrec_seq_len = self.hparams.config.sasrec_seq_len
         sasrec_hidden_size = self.hparams.config.sasrec_hidden_size
@@ -409,47 +895,35 @@ class PreInferOPTSeqRec(OPTSeqRec):
         output = self.classification_head(output)
         return output  # (B, L, N_items)
 
-    def training_step(self, batch, batch_idx):
+    def _dispatch_forward(self, batch):
         if self.opt is None:
             # using the AllFreezePreInferSeqDataset
-            target_seq, _, item_seq_mask, item_embs = batch
+            target_seq, _, item_seq_mask, last_item_idx, item_embs = batch
             seq_emb = self.forward(item_seq_mask,
                                    item_embs=item_embs)
         else:
             # using the PreInferSeqDataset
-            target_seq, _, item_seq_mask, \
+            target_seq, _, item_seq_mask, last_item_idx, \
                 inputs_hidden_state, attention_mask = batch
             # (B, L, N_items)
             seq_emb = self.forward(item_seq_mask,
                                    inputs_hidden_state=inputs_hidden_state,
                                    attention_mask=attention_mask)
-            
-        loss = self.loss_fct(seq_emb.reshape(-1, seq_emb.size(-1)),
-                             target_seq.reshape(-1))
+        return seq_emb, target_seq, last_item_idx
+
+    def training_step(self, batch, batch_idx):
+        seq_emb, target_seq, _ = self._dispatch_forward(batch)
+        loss = self._compute_loss(seq_emb, target_seq)
         return loss
 
     def _val_test_step(self, batch, batch_idx, stage):
-        if self.opt is None:
-            # using the AllFreezePreInferSeqDataset
-            target_seq, _, item_seq_mask, item_embs = batch
-            seq_emb = self.forward(item_seq_mask,
-                                   item_embs=item_embs)
-        else:
-            # using the PreInferSeqDataset
-            target_seq, _, item_seq_mask, \
-                inputs_hidden_state, attention_mask = batch
-            # (B, L, N_items)
-            seq_emb = self.forward(item_seq_mask,
-                                   inputs_hidden_state=inputs_hidden_state,
-                                   attention_mask=attention_mask)
-             
-        last_item_idx = torch.sum(item_seq_mask, dim=-1) - 1  # (B)
+        seq_emb, target_seq, last_item_idx = self._dispatch_forward(batch)
         seq_last_emb = gather_indexes(seq_emb, last_item_idx)  # (B, N_items)
         last_id = target_seq.gather(1, last_item_idx.view(-1, 1))  # (B, 1)
 
         topk_list = self.hparams.config.topk_list
-        pred_scores = seq_last_emb.softmax(dim=-1)
-        all_ranks = get_topk_ranks(pred_scores=pred_scores,
+        # softmax is monotonic, so rank the logits directly
+        all_ranks = get_topk_ranks(pred_scores=seq_last_emb,
                                    target=last_id,
                                    topk=max(topk_list))
 
@@ -1,3 +1,4 @@
+import re
 from transformers import OPTModel, BertModel
 import torch
 
@@ -14,6 +15,10 @@ PRETRAIN_MODEL_ABBR = {
     "bert-large-uncased": "BERTLARGE",
 }
 
+# parameters of the PLMs excluded from weight decay
+NO_WEIGHT_DECAY_PATTERN = re.compile(r"bias|LayerNorm\.weight")
+
+
 def gather_indexes(output, gather_index):
     gather_index = gather_index.view(-1, 1, 1).expand(-1, -1, output.shape[-1])
     output_tensor = output.gather(dim=1, index=gather_index)
@@ -21,22 +26,18 @@ def gather_indexes(output, gather_index):
 
 
 def mean_pooling(embs, mask):
-    mask_expanded = mask.unsqueeze(-1).expand_as(embs)
-    sum_embs = (embs * mask_expanded).sum(dim=-2)
-    num_mask = torch.clamp(mask_expanded.sum(dim=-2), min=1e-9)
-    output = sum_embs / num_mask
-    return output.type_as(embs)
+    mask_sum = mask.sum(dim=-1, keepdim=True)
+    num_mask = torch.clamp(mask_sum.type_as(embs), min=1e-9)
+    # (N, 1, L) @ (N, L, H), reads embs once without a masked temporary
+    sum_embs = torch.bmm(mask.unsqueeze(-2).type_as(embs), embs).squeeze(-2)
+    # both operands are already in the dtype of embs
+    return sum_embs / num_mask
 
 
 def last_pooling(embs, mask):
-    batch_size = mask.shape[0]
-    sentence_len = mask.shape[1]
-    last_embs_idx = mask.sum(dim=-1) - 1
-    cumsum_idx = torch.tensor(sentence_len).expand(batch_size).cumsum(
-        0).type_as(last_embs_idx)
-    last_embs_idx[1:] += cumsum_idx[:-1]
-    output = embs.view(-1, embs.size(-1))[last_embs_idx]
-    return output.type_as(embs)
+    # index of the last valid token, assuming right padding
+    last_idx = mask.sum(dim=-1) - 1
+    return gather_indexes(embs, last_idx)
 
 
 def get_plm_configs(plm):
@@ -53,3 +54,44 @@ def get_plm_configs(plm):
 
     return output_size, plm_hidden_size, plm_n_layers, \
          plm_n_heads, plm_n_embd, plm_dropout_prob
+
+
+class CUDAGraphRunner:
+    """Capture `forward_fn` over `static_inputs` into a CUDA graph on the first
+    replay, then replay it after new inputs are copied into `static_inputs`.
+
+    The graph must wrap a forward pass without autograd, e.g. the frozen PLM.
+    Graphs sharing a memory `pool` must not be replayed concurrently.
+    """
+
+    def __init__(self, forward_fn, static_inputs, pool=None, n_warmup=3):
+        self.forward_fn = forward_fn
+        self.static_inputs = static_inputs
+        self.pool = pool
+        self.n_warmup = n_warmup
+        self.graph = None
+        self.static_output = None
+
+    def capture(self):
+        # warmup on a side stream before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.n_warmup):
+                self.forward_fn(*self.static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # autocast must not cache casted weights during the capture
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.autocast(device_type="cuda",
+                            dtype=torch.get_autocast_gpu_dtype(),
+                            enabled=torch.is_autocast_enabled(),
+                            cache_enabled=False):
+            with torch.cuda.graph(self.graph, pool=self.pool):
+                self.static_output = self.forward_fn(*self.static_inputs)
+
+    def replay(self):
+        if self.graph is None:
+            self.capture()
+        self.graph.replay()
+        return self.static_output